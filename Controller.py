@@ -16,12 +16,15 @@ worker = SwarmWorker()
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--action', choices=['initSwarm', 'newService', 'joinSwarm', 'rmService', 'leaveSwarm',
-                                             'inspectTask', 'inspectTasks', 'listNodes', 'getNodeID', 'inspectTaskName'],
+                                             'inspectTask', 'inspectTasks', 'listNodes', 'getNodeID', 'inspectTaskName',
+                                             'streamTasks'],
                         type=str, help='DynamicDockerSwarm action')
     parser.add_argument('--service', required=False, type=str, help='Service definition')
     parser.add_argument('--remote_addr', required=False, type=str, default=None, help='Remote address')
     parser.add_argument('--join_token', required=False, type=str, default=None, help='Docker Swarm join token.')
     parser.add_argument('--task_name', required=False, type=str, help='Specific task name')
+    parser.add_argument('--duration', required=False, type=float, default=None, help='Streaming time bound in seconds')
+    parser.add_argument('--max_rate', required=False, type=float, default=None, help='Max lines per second per stream')
 
     args = parser.parse_args()
     action = args.action
@@ -58,4 +61,10 @@ if __name__ == '__main__':
         base.getNodeID()
     elif action == 'inspectTaskName':
         sv_name = serviceInfo
-        master.inspect_task_name(sv_name)
\ No newline at end of file
+        master.inspect_task_name(sv_name)
+    elif action == 'streamTasks':
+        if not serviceInfo:
+            print('Service names must be specified, separated by commas.')
+        else:
+            sv_names = serviceInfo.split(',')
+            master.stream_tasks(sv_names, duration=args.duration, max_rate=args.max_rate)
\ No newline at end of file
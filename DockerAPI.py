@@ -6,6 +6,8 @@ import json
 import docker
 import traceback
 import utl
+from TaskStreamer import TaskStreamer
+from TaskStreamer import split_lines
 
 
 class BaseDocker(object):
@@ -223,6 +225,68 @@ class SwarmMaster(BaseDocker):
                 self.logger.info(sv.tasks())
                 return
 
+    def stream_tasks(self, sv_names, duration=None, max_rate=None, queue_size=1000, with_stats=True):
+        """
+        Follow logs and live stats of all tasks of one or more services concurrently
+        :param sv_names: list of service names
+        :param duration: stop after this many seconds, None means follow until interrupted
+        :param max_rate: max lines per second accepted from one stream
+        :param queue_size: capacity of the shared output queue
+        :param with_stats: also follow stats of task containers running on this node
+        :return: per stream summary, see TaskStreamer.summary
+        """
+        streamer = TaskStreamer(queue_size=queue_size, max_rate=max_rate, duration=duration)
+        for sv in self.list_services():
+            if sv.name not in sv_names:
+                continue
+            # one service log stream carries every task, details=True labels each line with its task and node
+            chunks = sv.logs(details=True, follow=True, stdout=True, stderr=True, tail=0)
+            streamer.add_stream(sv.name, '*', 'log', self.__tag_service_log(split_lines(chunks)))
+            if not with_stats:
+                continue
+            for task in sv.tasks(filters={'desired-state': 'running'}):
+                container_id = task.get('Status', {}).get('ContainerStatus', {}).get('ContainerID')
+                if not container_id:
+                    continue
+                try:
+                    container = self.client.containers.get(container_id)
+                except docker.errors.NotFound:
+                    # stats are only served by the daemon that runs the container
+                    self.logger.info('Skip stats of task %s, container is not on this node.' % task['ID'])
+                    continue
+                streamer.add_stream(task['ID'], task.get('NodeID', '*'), 'stats',
+                                    self.__format_stats(container.stats(stream=True, decode=True)))
+
+        try:
+            streamer.run(lambda task, node, kind, line: self.logger.info('[%s@%s][%s] %s' % (task, node, kind, line)))
+        except KeyboardInterrupt:
+            streamer.stop()
+        summary = streamer.summary()
+        for record in summary:
+            self.logger.info('[%s@%s][%s] emitted=%d dropped=%d rate_limited=%d' % record)
+        return summary
+
+    @staticmethod
+    def __tag_service_log(lines):
+        # line format: com.docker.swarm.node.id=...,com.docker.swarm.service.id=...,com.docker.swarm.task.id=... msg
+        for line in lines:
+            labels, _, msg = line.partition(' ')
+            attrs = dict(attr.split('=', 1) for attr in labels.split(',') if '=' in attr)
+            if 'com.docker.swarm.task.id' not in attrs:
+                yield line
+                continue
+            yield attrs['com.docker.swarm.task.id'], attrs.get('com.docker.swarm.node.id', '*'), msg
+
+    @staticmethod
+    def __format_stats(stats):
+        for st in stats:
+            cpu_delta = st['cpu_stats']['cpu_usage']['total_usage'] - st['precpu_stats']['cpu_usage']['total_usage']
+            sys_delta = st['cpu_stats'].get('system_cpu_usage', 0) - st['precpu_stats'].get('system_cpu_usage', 0)
+            cpus = st['cpu_stats'].get('online_cpus', 1)
+            cpu_percent = cpu_delta / sys_delta * cpus * 100.0 if sys_delta > 0 else 0.0
+            mem = st.get('memory_stats', {})
+            yield 'cpu=%.2f%% mem=%.1fm/%.1fm' % (cpu_percent, mem.get('usage', 0) / 1e6, mem.get('limit', 0) / 1e6)
+
     def list_nodes(self):
         """
         Get nodes id list
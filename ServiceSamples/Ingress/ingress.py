@@ -1,11 +1,14 @@
 import time
+import json
+import socket
+import threading
 import argparse
 import utl
 import paho.mqtt.client as mqtt
 
 
 class Subscriber(object):
-    def __init__(self, broker_address, topic):
+    def __init__(self, broker_address, topic, queue_size=1000, policy='block', sample_every=10, report_interval=10):
         # subscriber can register multiple topic, so topics is a list
         self.topic = topic
 
@@ -13,12 +16,19 @@ class Subscriber(object):
         self.broker_port = 1883
 
         mqtt.Client.connected_flag = False
-        self.mqtt_client = mqtt.Client()
+        # a persistent session keeps the subscription and queues QoS 1/2 messages at the broker while paused
+        self.mqtt_client = mqtt.Client(client_id='Ingress-%s' % socket.gethostname(), clean_session=False)
+        self.resumed = threading.Event()
 
         self.logger = utl.get_logger('Ingress.json', 'IngressLog')
 
         self.turn = 1
 
+        # messages are handed from the network thread to the handling thread through a bounded queue
+        self.queue = utl.MessageQueue(maxsize=queue_size, policy=policy, sample_every=sample_every,
+                                      on_pause=self.pause, on_resume=self.resume)
+        self.report_interval = report_interval
+
     def on_connect(self, client, userdata, flags, rc):
         if rc == 0:
             client.connected_flag = True  # set flag
@@ -28,15 +38,48 @@ class Subscriber(object):
             self.logger.info("Bad connection Returned code=%s" % str(rc))
 
     def on_message(self, client, userdata, message):
-        payload = message.payload.decode()
+        self.queue.put(message.payload)
+
+    def pause(self):
+        # runs on the network thread, which ends its loop once disconnected
+        self.mqtt_client.disconnect()
+        self.logger.info('Queue is above high watermark, paused subscription: %s' % self.topic)
+
+    def resume(self):
+        # reconnecting is left to the main thread, see handler
+        self.resumed.set()
+        self.logger.info('Queue is drained, resuming subscription: %s' % self.topic)
+
+    def report(self):
+        stats = self.queue.stats()
+        self.mqtt_client.publish(topic='%s/metrics' % self.topic, payload=json.dumps(stats))
+        self.logger.info('[Metrics] %s' % json.dumps(stats))
+
+    def consume(self):
+        report_flag = time.time()
+        while True:
+            payload = self.queue.get(timeout=1)
+            try:
+                if payload is not None:
+                    self.process(payload)
+            except Exception as ex:
+                # a bad message must not stop the thread draining the queue
+                self.queue.mark_failed()
+                self.logger.error('Failed to handle message %r: %s' % (payload, ex))
+            if time.time() - report_flag > self.report_interval:
+                self.report()
+                report_flag = time.time()
+
+    def process(self, payload):
+        payload = payload.decode()
         self.logger.info('[Subscribe] %s' % payload)
         # transfer messages
         if self.turn == 1:
-            self.mqtt_client.publish(topic='%s/ingress/1' % self.topic, payload=payload)
+            self.mqtt_client.publish(topic='%s/ingress/1' % self.topic, payload=payload, qos=2)
             self.turn = 0
             self.logger.info('[Publish] %s' % payload)
         else:
-            self.mqtt_client.publish(topic='%s/ingress/2' % self.topic, payload=payload)
+            self.mqtt_client.publish(topic='%s/ingress/2' % self.topic, payload=payload, qos=2)
             self.turn = 1
             self.logger.info('[Publish] %s' % payload)
 
@@ -51,19 +94,32 @@ class Subscriber(object):
             time.sleep(1)
             self.logger.info("Main Loop")
 
+        consumer = threading.Thread(target=self.consume)
+        consumer.daemon = True
+        consumer.start()
+
         # set Qos to 2
         self.mqtt_client.subscribe(topic=self.topic, qos=2)
         self.logger.info("Subscribed new topic: %s" % self.topic)
 
-        # make subscriber loop forever to listen messages from broker
-        self.mqtt_client.loop_forever()
-        self.mqtt_client.disconnect()
+        # the network loop runs on its own thread; after pause() disconnected it, reconnect here on resume()
+        while True:
+            self.resumed.wait()
+            self.resumed.clear()
+            self.mqtt_client.loop_stop()
+            self.mqtt_client.reconnect()
+            self.mqtt_client.loop_start()
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('-t', '--topic', type=str, help='Topic')
     parser.add_argument('-a', '--address', type=str, help='Broker address')
+    parser.add_argument('-q', '--queue_size', type=int, default=1000, help='Max number of queued messages')
+    parser.add_argument('-p', '--policy', type=str, default='block', choices=utl.MessageQueue.POLICIES,
+                        help='What to do when the queue is full')
+    parser.add_argument('-s', '--sample_every', type=int, default=10, help='Keep 1 of N messages under sample policy')
     args = parser.parse_args()
-    sub = Subscriber(args.address, args.topic)
+    sub = Subscriber(args.address, args.topic, queue_size=args.queue_size, policy=args.policy,
+                     sample_every=args.sample_every)
     sub.handler()
\ No newline at end of file
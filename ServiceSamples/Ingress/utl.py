@@ -1,6 +1,8 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 import logging
+import threading
+import collections
 
 
 def get_logger(logger_name, log_file, enable_stream=True):
@@ -22,4 +24,102 @@ def get_logger(logger_name, log_file, enable_stream=True):
     if enable_stream:
         logger.addHandler(cl)
 
-    return logger
\ No newline at end of file
+    return logger
+
+
+class MessageQueue(object):
+    """
+    Bounded hand-off queue between the paho network thread and the message handling thread.
+    When the queue is full, the policy decides what to shed:
+        block       - the network thread waits for room, so the broker window stalls instead of our memory
+        drop-oldest - evict the oldest queued message to make room for the new one
+        sample      - above the high watermark keep only one of every sample_every messages
+        pause       - at the high watermark call on_pause, which should stop delivery at the broker (e.g. disconnect
+                      a persistent session so QoS 1/2 messages stay queued there), and call on_resume once the
+                      queue drained to the low watermark; the network thread never waits, messages still in
+                      flight are queued up to maxsize and shed beyond it
+    """
+    POLICIES = ['block', 'drop-oldest', 'sample', 'pause']
+
+    def __init__(self, maxsize=1000, policy='block', sample_every=10, high_ratio=0.8, low_ratio=0.5,
+                 on_pause=None, on_resume=None):
+        assert policy in self.POLICIES
+        assert maxsize > 0
+        self.maxsize = maxsize
+        self.policy = policy
+        self.sample_every = max(1, sample_every)
+        self.high_mark = max(1, int(maxsize * high_ratio))
+        self.low_mark = min(int(maxsize * low_ratio), self.high_mark - 1)
+        self.on_pause = on_pause
+        self.on_resume = on_resume
+
+        self.__items = collections.deque()
+        self.__cond = threading.Condition()
+        self.__sample_turn = 0
+        self.paused = False
+        self.accepted = 0
+        self.shed = 0
+        self.failed = 0
+
+    def put(self, item):
+        """
+        :return: True if item is queued, False if it is shed
+        """
+        pause = False
+        with self.__cond:
+            if self.policy == 'block':
+                while len(self.__items) >= self.maxsize:
+                    self.__cond.wait()
+            elif self.policy == 'drop-oldest':
+                if len(self.__items) >= self.maxsize:
+                    self.__items.popleft()
+                    self.shed += 1
+            elif self.policy == 'sample':
+                if len(self.__items) >= self.high_mark:
+                    self.__sample_turn = (self.__sample_turn + 1) % self.sample_every
+                    if self.__sample_turn or len(self.__items) >= self.maxsize:
+                        self.shed += 1
+                        return False
+            elif self.policy == 'pause':
+                if len(self.__items) >= self.high_mark and not self.paused:
+                    self.paused = pause = True
+            accepted = len(self.__items) < self.maxsize
+            if accepted:
+                self.__items.append(item)
+                self.accepted += 1
+                self.__cond.notify_all()
+            else:
+                self.shed += 1
+        if pause and self.on_pause:
+            self.on_pause()
+        return accepted
+
+    def get(self, timeout=None):
+        """
+        :return: the oldest item, or None on timeout
+        """
+        with self.__cond:
+            if not self.__items:
+                self.__cond.wait(timeout)
+                if not self.__items:
+                    return None
+            item = self.__items.popleft()
+            self.__cond.notify_all()
+            resume = self.paused and len(self.__items) <= self.low_mark
+            if resume:
+                self.paused = False
+        if resume and self.on_resume:
+            self.on_resume()
+        return item
+
+    def mark_failed(self):
+        """
+        Count a message the handling thread took off the queue but could not process
+        """
+        with self.__cond:
+            self.failed += 1
+
+    def stats(self):
+        with self.__cond:
+            return {'depth': len(self.__items), 'maxsize': self.maxsize, 'policy': self.policy,
+                    'accepted': self.accepted, 'shed': self.shed, 'failed': self.failed, 'paused': self.paused}
@@ -1,4 +1,7 @@
 import time
+import json
+import socket
+import threading
 import argparse
 import utl
 import math
@@ -6,20 +9,35 @@ import paho.mqtt.client as mqtt
 
 
 class Subscriber(object):
-    def __init__(self, broker_address, topic):
+    def __init__(self, broker_address, topic, queue_size=1000, policy='block', sample_every=10, report_interval=10,
+                 window=5, shards=1, key_field=None, group=None):
         # subscriber can register multiple topic, so topics is a list
         self.topic = topic
+        # replicas of one Map service join a shared subscription so every record reaches exactly one of them,
+        # otherwise each replica would aggregate the whole stream and Reduce would count it once per replica
+        self.subscription = '$share/%s/%s' % (group, topic) if group else topic
 
         self.broker_address = broker_address
         self.broker_port = 1883
 
         mqtt.Client.connected_flag = False
-        self.mqtt_client = mqtt.Client()
+        # a persistent session keeps the subscription and queues QoS 1/2 messages at the broker while paused
+        self.mqtt_client = mqtt.Client(client_id='Map-%s' % socket.gethostname(), clean_session=False)
+        self.resumed = threading.Event()
 
         self.logger = utl.get_logger('Map', 'MapLog')
 
-        self.time_flag = time.time()
-        self.buffer = []
+        # partial aggregates per (window start, key); windows are aligned to the clock so replicas agree on them
+        self.window = window
+        self.shards = shards
+        self.key_field = key_field
+        self.partials = {}
+        self.source = socket.gethostname()
+
+        # messages are handed from the network thread to the handling thread through a bounded queue
+        self.queue = utl.MessageQueue(maxsize=queue_size, policy=policy, sample_every=sample_every,
+                                      on_pause=self.pause, on_resume=self.resume)
+        self.report_interval = report_interval
 
     def on_connect(self, client, userdata, flags, rc):
         if rc == 0:
@@ -30,18 +48,71 @@ class Subscriber(object):
             self.logger.info("Bad connection Returned code=%s" % str(rc))
 
     def on_message(self, client, userdata, message):
-        payload = message.payload.decode()
+        self.queue.put(message.payload)
+
+    def pause(self):
+        # runs on the network thread, which ends its loop once disconnected
+        self.mqtt_client.disconnect()
+        self.logger.info('Queue is above high watermark, paused subscription: %s' % self.topic)
+
+    def resume(self):
+        # reconnecting is left to the main thread, see handler
+        self.resumed.set()
+        self.logger.info('Queue is drained, resuming subscription: %s' % self.topic)
+
+    def report(self):
+        stats = self.queue.stats()
+        self.mqtt_client.publish(topic='%s/metrics' % self.topic, payload=json.dumps(stats))
+        self.logger.info('[Metrics] %s' % json.dumps(stats))
+
+    def consume(self):
+        report_flag = time.time()
+        while True:
+            payload = self.queue.get(timeout=1)
+            try:
+                if payload is not None:
+                    self.process(payload)
+            except Exception as ex:
+                # a bad message must not stop the thread draining the queue
+                self.queue.mark_failed()
+                self.logger.error('Failed to handle message %r: %s' % (payload, ex))
+            try:
+                self.flush(time.time())
+            except Exception as ex:
+                self.logger.error('Failed to publish finished windows: %s' % ex)
+            if time.time() - report_flag > self.report_interval:
+                self.report()
+                report_flag = time.time()
+
+    def process(self, payload):
+        payload = payload.decode()
         self.logger.info('[Subscribe] %s' % payload)
-        # transfer messages
-        if time.time() - self.time_flag > 5:
-            record = [float(i.split(',')[2]) for i in self.buffer]
-            payload = sum(record)/len(record)
-            self.mqtt_client.publish(topic='%s/map' % self.topic, payload=str(payload))
-            self.logger.info('[Publish] %s' % str(payload))
-            self.buffer = []
-            self.time_flag = time.time()
-        else:
-            self.buffer.append(payload)
+        fields = payload.split(',')
+        key = fields[self.key_field] if self.key_field is not None else '*'
+        start = int(time.time() // self.window) * self.window
+        if (start, key) not in self.partials:
+            self.partials[(start, key)] = utl.Aggregate()
+        self.partials[(start, key)].add(float(fields[2]))
+
+    def flush(self, now):
+        """
+        Publish partials of every finished window, one message per window and shard
+        """
+        closed = [w for w in self.partials if w[0] + self.window <= now]
+        batches = {}
+        for start, key in closed:
+            batches.setdefault((start, utl.shard_of(key, self.shards)), []).append(key)
+        for (start, shard), keys in sorted(batches.items()):
+            batch = {key: self.partials[(start, key)].to_dict() for key in keys}
+            payload = json.dumps({'window': start, 'size': self.window, 'source': self.source, 'partials': batch})
+            info = self.mqtt_client.publish(topic='%s/map/%d' % (self.topic, shard), payload=payload, qos=2)
+            # while paused paho answers NO_CONN but keeps the QoS 2 message and sends it after reconnecting
+            if info.rc not in (mqtt.MQTT_ERR_SUCCESS, mqtt.MQTT_ERR_NO_CONN):
+                raise IOError('publish returned %d, window %d shard %d kept for retry' % (info.rc, start, shard))
+            # partials are only dropped once the broker or paho owns them, a retried batch is deduplicated by Reduce
+            for key in keys:
+                del self.partials[(start, key)]
+            self.logger.info('[Publish] window %d shard %d keys %d' % (start, shard, len(batch)))
 
     # handle mqtt service
     def handler(self):
@@ -54,19 +125,38 @@ class Subscriber(object):
             time.sleep(1)
             self.logger.info("Main Loop")
 
+        consumer = threading.Thread(target=self.consume)
+        consumer.daemon = True
+        consumer.start()
+
         # set Qos to 2
-        self.mqtt_client.subscribe(topic=self.topic, qos=2)
-        self.logger.info("Subscribed new topic: %s" % self.topic)
+        self.mqtt_client.subscribe(topic=self.subscription, qos=2)
+        self.logger.info("Subscribed new topic: %s" % self.subscription)
 
-        # make subscriber loop forever to listen messages from broker
-        self.mqtt_client.loop_forever()
-        self.mqtt_client.disconnect()
+        # the network loop runs on its own thread; after pause() disconnected it, reconnect here on resume()
+        while True:
+            self.resumed.wait()
+            self.resumed.clear()
+            self.mqtt_client.loop_stop()
+            self.mqtt_client.reconnect()
+            self.mqtt_client.loop_start()
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('-t', '--topic', type=str, help='Topic')
     parser.add_argument('-a', '--address', type=str, help='Broker address')
+    parser.add_argument('-q', '--queue_size', type=int, default=1000, help='Max number of queued messages')
+    parser.add_argument('-p', '--policy', type=str, default='block', choices=utl.MessageQueue.POLICIES,
+                        help='What to do when the queue is full')
+    parser.add_argument('-s', '--sample_every', type=int, default=10, help='Keep 1 of N messages under sample policy')
+    parser.add_argument('-w', '--window', type=int, default=5, help='Window size in seconds')
+    parser.add_argument('-n', '--shards', type=int, default=1, help='Number of Reduce shards')
+    parser.add_argument('-k', '--key_field', type=int, default=None, help='Index of the key field in a message')
+    parser.add_argument('-g', '--group', type=str, default=None,
+                        help='Shared subscription group, required when the service runs more than one replica')
     args = parser.parse_args()
-    sub = Subscriber(args.address, args.topic)
+    sub = Subscriber(args.address, args.topic, queue_size=args.queue_size, policy=args.policy,
+                     sample_every=args.sample_every, window=args.window, shards=args.shards, key_field=args.key_field,
+                     group=args.group)
     sub.handler()
\ No newline at end of file
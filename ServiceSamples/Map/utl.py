@@ -1,6 +1,10 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
+import zlib
+import math
 import logging
+import threading
+import collections
 
 
 def get_logger(logger_name, log_file, enable_stream=True):
@@ -22,4 +26,209 @@ def get_logger(logger_name, log_file, enable_stream=True):
     if enable_stream:
         logger.addHandler(cl)
 
-    return logger
\ No newline at end of file
+    return logger
+
+
+class MessageQueue(object):
+    """
+    Bounded hand-off queue between the paho network thread and the message handling thread.
+    When the queue is full, the policy decides what to shed:
+        block       - the network thread waits for room, so the broker window stalls instead of our memory
+        drop-oldest - evict the oldest queued message to make room for the new one
+        sample      - above the high watermark keep only one of every sample_every messages
+        pause       - at the high watermark call on_pause, which should stop delivery at the broker (e.g. disconnect
+                      a persistent session so QoS 1/2 messages stay queued there), and call on_resume once the
+                      queue drained to the low watermark; the network thread never waits, messages still in
+                      flight are queued up to maxsize and shed beyond it
+    """
+    POLICIES = ['block', 'drop-oldest', 'sample', 'pause']
+
+    def __init__(self, maxsize=1000, policy='block', sample_every=10, high_ratio=0.8, low_ratio=0.5,
+                 on_pause=None, on_resume=None):
+        assert policy in self.POLICIES
+        assert maxsize > 0
+        self.maxsize = maxsize
+        self.policy = policy
+        self.sample_every = max(1, sample_every)
+        self.high_mark = max(1, int(maxsize * high_ratio))
+        self.low_mark = min(int(maxsize * low_ratio), self.high_mark - 1)
+        self.on_pause = on_pause
+        self.on_resume = on_resume
+
+        self.__items = collections.deque()
+        self.__cond = threading.Condition()
+        self.__sample_turn = 0
+        self.paused = False
+        self.accepted = 0
+        self.shed = 0
+        self.failed = 0
+
+    def put(self, item):
+        """
+        :return: True if item is queued, False if it is shed
+        """
+        pause = False
+        with self.__cond:
+            if self.policy == 'block':
+                while len(self.__items) >= self.maxsize:
+                    self.__cond.wait()
+            elif self.policy == 'drop-oldest':
+                if len(self.__items) >= self.maxsize:
+                    self.__items.popleft()
+                    self.shed += 1
+            elif self.policy == 'sample':
+                if len(self.__items) >= self.high_mark:
+                    self.__sample_turn = (self.__sample_turn + 1) % self.sample_every
+                    if self.__sample_turn or len(self.__items) >= self.maxsize:
+                        self.shed += 1
+                        return False
+            elif self.policy == 'pause':
+                if len(self.__items) >= self.high_mark and not self.paused:
+                    self.paused = pause = True
+            accepted = len(self.__items) < self.maxsize
+            if accepted:
+                self.__items.append(item)
+                self.accepted += 1
+                self.__cond.notify_all()
+            else:
+                self.shed += 1
+        if pause and self.on_pause:
+            self.on_pause()
+        return accepted
+
+    def get(self, timeout=None):
+        """
+        :return: the oldest item, or None on timeout
+        """
+        with self.__cond:
+            if not self.__items:
+                self.__cond.wait(timeout)
+                if not self.__items:
+                    return None
+            item = self.__items.popleft()
+            self.__cond.notify_all()
+            resume = self.paused and len(self.__items) <= self.low_mark
+            if resume:
+                self.paused = False
+        if resume and self.on_resume:
+            self.on_resume()
+        return item
+
+    def mark_failed(self):
+        """
+        Count a message the handling thread took off the queue but could not process
+        """
+        with self.__cond:
+            self.failed += 1
+
+    def stats(self):
+        with self.__cond:
+            return {'depth': len(self.__items), 'maxsize': self.maxsize, 'policy': self.policy,
+                    'accepted': self.accepted, 'shed': self.shed, 'failed': self.failed, 'paused': self.paused}
+
+
+def shard_of(key, shards):
+    """
+    Stable key to shard mapping, identical in every process (unlike hash())
+    """
+    return zlib.crc32(key.encode()) % shards
+
+
+class Aggregate(object):
+    """
+    Mergeable partial aggregate: count, sum, min, max and a log-bucket quantile sketch.
+    The sketch keeps values within relative error alpha and never grows beyond max_buckets per sign,
+    the lowest magnitude buckets are collapsed first.
+    """
+
+    def __init__(self, alpha=0.01, max_buckets=512):
+        self.alpha = alpha
+        self.max_buckets = max_buckets
+        self.gamma = (1 + alpha) / (1 - alpha)
+        self.log_gamma = math.log(self.gamma)
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+        self.zero = 0
+        self.pos = {}
+        self.neg = {}
+
+    def add(self, value):
+        self.count += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+        if value > 0:
+            self.__insert(self.pos, int(math.ceil(math.log(value) / self.log_gamma)), 1)
+        elif value < 0:
+            self.__insert(self.neg, int(math.ceil(math.log(-value) / self.log_gamma)), 1)
+        else:
+            self.zero += 1
+
+    def merge(self, other):
+        assert self.alpha == other.alpha
+        if not other.count:
+            return
+        self.count += other.count
+        self.sum += other.sum
+        self.min = other.min if self.min is None else min(self.min, other.min)
+        self.max = other.max if self.max is None else max(self.max, other.max)
+        self.zero += other.zero
+        for store, buckets in ((self.pos, other.pos), (self.neg, other.neg)):
+            get = store.get
+            for index, n in buckets.items():
+                store[index] = get(index, 0) + n
+            if len(store) > self.max_buckets:
+                self.__collapse(store)
+
+    def __insert(self, store, index, n):
+        store[index] = store.get(index, 0) + n
+        if len(store) > self.max_buckets:
+            self.__collapse(store)
+
+    def __collapse(self, store):
+        # fold the lowest magnitude buckets into the first one that is kept
+        lowest = sorted(store)[:len(store) - self.max_buckets + 1]
+        store[lowest[-1]] += sum(store.pop(index) for index in lowest[:-1])
+
+    def __value(self, index):
+        return 2 * self.gamma ** index / (self.gamma + 1)
+
+    def quantile(self, q):
+        if not self.count:
+            return None
+        rank = q * (self.count - 1)
+        seen = 0
+        for index in sorted(self.neg, reverse=True):
+            seen += self.neg[index]
+            if seen > rank:
+                return max(self.min, -self.__value(index))
+        seen += self.zero
+        if seen > rank:
+            return 0.0
+        for index in sorted(self.pos):
+            seen += self.pos[index]
+            if seen > rank:
+                return min(self.max, self.__value(index))
+        return self.max
+
+    def mean(self):
+        return self.sum / self.count if self.count else None
+
+    def to_dict(self):
+        return {'alpha': self.alpha, 'count': self.count, 'sum': self.sum, 'min': self.min, 'max': self.max,
+                'zero': self.zero, 'pos': self.pos, 'neg': self.neg}
+
+    @classmethod
+    def from_dict(cls, d, max_buckets=512):
+        agg = cls(alpha=d['alpha'], max_buckets=max_buckets)
+        agg.count = d['count']
+        agg.sum = d['sum']
+        agg.min = d['min']
+        agg.max = d['max']
+        agg.zero = d['zero']
+        # json turns int keys into strings
+        agg.pos = {int(k): v for k, v in d['pos'].items()}
+        agg.neg = {int(k): v for k, v in d['neg'].items()}
+        return agg
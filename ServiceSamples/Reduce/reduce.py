@@ -0,0 +1,150 @@
+import os
+import time
+import json
+import socket
+import threading
+import argparse
+import utl
+import paho.mqtt.client as mqtt
+
+
+class Subscriber(object):
+    def __init__(self, broker_address, topic, output, shard=0, lateness=5, queue_size=1000, policy='block',
+                 sample_every=10, report_interval=10):
+        # every Reduce replica only subscribes to the partials routed to its own shard
+        self.shard = shard
+        self.topic = '%s/map/%d' % (topic, shard)
+        self.output = output
+
+        self.broker_address = broker_address
+        self.broker_port = 1883
+
+        mqtt.Client.connected_flag = False
+        # a persistent session keeps the subscription and queues QoS 1/2 messages at the broker while paused
+        self.mqtt_client = mqtt.Client(client_id='Reduce-%s' % socket.gethostname(), clean_session=False)
+        self.resumed = threading.Event()
+
+        self.logger = utl.get_logger('Reduce', 'ReduceLog')
+
+        self.merger = utl.WindowMerger(lateness=lateness)
+
+        # messages are handed from the network thread to the handling thread through a bounded queue
+        self.queue = utl.MessageQueue(maxsize=queue_size, policy=policy, sample_every=sample_every,
+                                      on_pause=self.pause, on_resume=self.resume)
+        self.report_interval = report_interval
+
+    def on_connect(self, client, userdata, flags, rc):
+        if rc == 0:
+            client.connected_flag = True  # set flag
+            self.logger.info("Connected to broker")
+        else:
+            client.connected_flag = False
+            self.logger.info("Bad connection Returned code=%s" % str(rc))
+
+    def on_message(self, client, userdata, message):
+        self.queue.put(message.payload)
+
+    def pause(self):
+        # runs on the network thread, which ends its loop once disconnected
+        self.mqtt_client.disconnect()
+        self.logger.info('Queue is above high watermark, paused subscription: %s' % self.topic)
+
+    def resume(self):
+        # reconnecting is left to the main thread, see handler
+        self.resumed.set()
+        self.logger.info('Queue is drained, resuming subscription: %s' % self.topic)
+
+    def report(self):
+        stats = self.queue.stats()
+        stats.update({'shard': self.shard, 'watermark': self.merger.watermark, 'late': self.merger.late,
+                      'duplicate': self.merger.duplicate, 'open_windows': len(self.merger.windows)})
+        self.mqtt_client.publish(topic='%s/metrics' % self.output, payload=json.dumps(stats))
+        self.logger.info('[Metrics] %s' % json.dumps(stats))
+
+    def consume(self):
+        report_flag = time.time()
+        while True:
+            payload = self.queue.get(timeout=1)
+            try:
+                if payload is not None:
+                    self.process(payload)
+            except Exception as ex:
+                # a bad message must not stop the thread draining the queue
+                self.queue.mark_failed()
+                self.logger.error('Failed to handle message %r: %s' % (payload, ex))
+            try:
+                self.flush(time.time())
+            except Exception as ex:
+                self.logger.error('Failed to publish finished windows: %s' % ex)
+            if time.time() - report_flag > self.report_interval:
+                self.report()
+                report_flag = time.time()
+
+    def process(self, payload):
+        batch = json.loads(payload.decode())
+        self.logger.info('[Subscribe] window %d from %s keys %d' % (batch['window'], batch['source'],
+                                                                     len(batch['partials'])))
+        partials = {key: utl.Aggregate.from_dict(partial) for key, partial in batch['partials'].items()}
+        if not self.merger.add(batch['window'], batch['size'], batch['source'], partials):
+            self.logger.info('[Dropped] late or duplicate window %d from %s' % (batch['window'], batch['source']))
+
+    def flush(self, now):
+        """
+        Publish every window the watermark has passed
+        """
+        for start, size, partials, window in self.merger.advance(now):
+            results = {}
+            for key, agg in window.items():
+                results[key] = {'count': agg.count, 'sum': agg.sum, 'min': agg.min, 'max': agg.max,
+                                'mean': agg.mean(), 'p50': agg.quantile(0.5), 'p95': agg.quantile(0.95),
+                                'p99': agg.quantile(0.99)}
+            payload = json.dumps({'window': start, 'size': size, 'shard': self.shard, 'partials': partials,
+                                  'results': results})
+            self.mqtt_client.publish(topic='%s/%d' % (self.output, self.shard), payload=payload, qos=1)
+            self.logger.info('[Publish] window %d keys %d batches %d' % (start, len(results), partials))
+
+    # handle mqtt service
+    def handler(self):
+        self.mqtt_client.on_connect = self.on_connect
+        self.mqtt_client.on_message = self.on_message
+        self.mqtt_client.loop_start()
+        self.mqtt_client.connect(host=self.broker_address, port=self.broker_port)
+        while not self.mqtt_client.connected_flag:  # wait in loop
+            self.logger.info("In wait loop")
+            time.sleep(1)
+            self.logger.info("Main Loop")
+
+        consumer = threading.Thread(target=self.consume)
+        consumer.daemon = True
+        consumer.start()
+
+        # set Qos to 2
+        self.mqtt_client.subscribe(topic=self.topic, qos=2)
+        self.logger.info("Subscribed new topic: %s" % self.topic)
+
+        # the network loop runs on its own thread; after pause() disconnected it, reconnect here on resume()
+        while True:
+            self.resumed.wait()
+            self.resumed.clear()
+            self.mqtt_client.loop_stop()
+            self.mqtt_client.reconnect()
+            self.mqtt_client.loop_start()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-t', '--topic', type=str, help='Topic of Map outputs, wildcards allowed, e.g. light/ingress/+')
+    parser.add_argument('-o', '--output', type=str, help='Topic to publish merged windows to')
+    parser.add_argument('-a', '--address', type=str, help='Broker address')
+    # in swarm mode TASK_SLOT is set from {{.Task.Slot}}, which starts at 1
+    parser.add_argument('-i', '--shard', type=int, default=int(os.environ.get('TASK_SLOT', 1)) - 1,
+                        help='Shard served by this replica')
+    parser.add_argument('-l', '--lateness', type=int, default=5, help='Allowed lateness in seconds')
+    parser.add_argument('-q', '--queue_size', type=int, default=1000, help='Max number of queued messages')
+    parser.add_argument('-p', '--policy', type=str, default='block', choices=utl.MessageQueue.POLICIES,
+                        help='What to do when the queue is full')
+    parser.add_argument('-s', '--sample_every', type=int, default=10, help='Keep 1 of N messages under sample policy')
+    args = parser.parse_args()
+    sub = Subscriber(args.address, args.topic, args.output, shard=args.shard, lateness=args.lateness,
+                     queue_size=args.queue_size, policy=args.policy, sample_every=args.sample_every)
+    sub.handler()
@@ -0,0 +1,297 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+import tracemalloc
+import importlib.util
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SERVICES = ['Ingress', 'Map', 'Reduce']
+
+
+def load_utl(service):
+    """
+    Every service image ships its own copy of utl.py, load one of them under its own module name
+    """
+    spec = importlib.util.spec_from_file_location('%s_utl' % service, os.path.join(HERE, service, 'utl.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+utl = load_utl('Reduce')
+sys.path.insert(0, os.path.dirname(HERE))
+from TaskStreamer import TaskStreamer
+
+
+def overload(mq_class, policy, queue_size, duration, produce_rate, consume_rate, payload_size):
+    """
+    Push messages into a MessageQueue much faster than they are consumed and measure what it holds
+    :return: dict of results
+    """
+    pauses = [0]
+    paused = threading.Event()
+
+    def on_pause():
+        pauses[0] += 1
+        paused.set()
+
+    mq = mq_class(maxsize=queue_size, policy=policy, on_pause=on_pause, on_resume=paused.clear)
+    stop = threading.Event()
+    produced = [0]
+    held = [0]
+    consumed = [0]
+    max_depth = [0]
+
+    def produce():
+        # stand-in for the broker and the paho network thread: messages keep being published, a paused
+        # persistent session holds them at the broker and gets the backlog delivered once resumed
+        interval = 1.0 / produce_rate
+        while not stop.is_set():
+            produced[0] += 1
+            held[0] += 1
+            while held[0] and not paused.is_set() and not stop.is_set():
+                mq.put(b'%d,%f,' % (produced[0], time.time()) + b'x' * payload_size)
+                held[0] -= 1
+            time.sleep(interval)
+
+    def consume():
+        interval = 1.0 / consume_rate
+        while not stop.is_set():
+            if mq.get(timeout=0.1) is not None:
+                consumed[0] += 1
+                time.sleep(interval)
+
+    tracemalloc.start()
+    threads = [threading.Thread(target=produce), threading.Thread(target=consume)]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    deadline = time.time() + duration
+    while time.time() < deadline:
+        max_depth[0] = max(max_depth[0], mq.stats()['depth'])
+        time.sleep(0.01)
+    stop.set()
+    for t in threads:
+        t.join(1)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    result = mq.stats()
+    # every published message must be consumed, still queued, held at the broker or counted as shed
+    result.update({'produced': produced[0], 'consumed': consumed[0], 'held': held[0], 'max_depth': max_depth[0],
+                   'pauses': pauses[0], 'peak_kb': peak / 1024.0,
+                   'lost': produced[0] - consumed[0] - result['depth'] - held[0] - result['shed']})
+    return result
+
+
+def reduce_merge(sources, keys, windows, size, values, shards, lateness, late_ratio, dup_ratio):
+    """
+    Feed synthetic Map output through a broker stand-in into one WindowMerger per shard, with some batches
+    delivered after the lateness allowance and some delivered twice, then check every merged window against
+    aggregates computed from the raw values of the batches that should have been merged
+    :return: dict of results
+    """
+    rnd = random.Random(0)
+    exact = {}
+    broker = []
+    injected_late = 0
+    injected_dup = 0
+    for w in range(windows):
+        start = w * size
+        for src in range(sources):
+            batches = {}
+            raws = {}
+            for k in range(keys):
+                key = 'key%d' % k
+                shard = utl.shard_of(key, shards)
+                agg = utl.Aggregate()
+                for _ in range(values):
+                    v = rnd.lognormvariate(0, 1) * rnd.choice([1, 1, 1, -1])
+                    agg.add(v)
+                    raws.setdefault(shard, []).append((key, v))
+                batches.setdefault(shard, {})[key] = agg.to_dict()
+            for shard, batch in batches.items():
+                payload = json.dumps({'window': start, 'size': size, 'source': 'map%d' % src, 'partials': batch})
+                if rnd.random() < late_ratio:
+                    # delivered after its window closed, must be dropped
+                    broker.append((start + size + lateness + rnd.uniform(0.1, size), shard, payload))
+                    injected_late += 1
+                    continue
+                # Map publishes at the end of the window, delivery is delayed by less than the lateness
+                arrival = start + size + rnd.uniform(0, lateness)
+                broker.append((arrival, shard, payload))
+                for key, v in raws[shard]:
+                    exact.setdefault((start, key), []).append(v)
+                if rnd.random() < dup_ratio:
+                    # QoS redelivery while the window is still open, must be dropped
+                    broker.append((rnd.uniform(arrival, start + size + lateness), shard, payload))
+                    injected_dup += 1
+    broker.sort()
+
+    mergers = [utl.WindowMerger(lateness=lateness) for _ in range(shards)]
+    closed = []
+    merged_keys = 0
+    begin = time.time()
+    for arrival, shard, payload in broker:
+        # the Reduce service flushes on every loop, so windows close as the clock moves between batches
+        closed.extend(mergers[shard].advance(arrival))
+        batch = json.loads(payload)
+        partials = {key: utl.Aggregate.from_dict(partial) for key, partial in batch['partials'].items()}
+        if mergers[shard].add(batch['window'], batch['size'], batch['source'], partials):
+            merged_keys += len(partials)
+    for merger in mergers:
+        closed.extend(merger.advance(float('inf')))
+    elapsed = time.time() - begin
+
+    errors = 0
+    max_rel_err = 0.0
+    for start, _, _, window in closed:
+        for key, agg in window.items():
+            raw = sorted(exact.pop((start, key)))
+            if agg.count != len(raw) or abs(agg.sum - sum(raw)) > 1e-6 * len(raw) or \
+                    agg.min != raw[0] or agg.max != raw[-1]:
+                errors += 1
+            for q in (0.5, 0.95, 0.99):
+                truth = raw[int(q * (len(raw) - 1))]
+                max_rel_err = max(max_rel_err, abs(agg.quantile(q) - truth) / abs(truth))
+    return {'batches': len(broker), 'merged_keys': merged_keys, 'elapsed': elapsed, 'errors': errors,
+            'missing': len(exact), 'late': sum(m.late for m in mergers), 'injected_late': injected_late,
+            'duplicate': sum(m.duplicate for m in mergers), 'injected_dup': injected_dup,
+            'max_rel_err': max_rel_err}
+
+
+def replica_split(replicas, records, windows, size, keys, shared):
+    """
+    Run one raw stream through several Map replicas and Reduce. The broker stand-in hands every record to
+    one replica under a shared subscription, or to all of them under a plain one.
+    :return: (windows and keys whose merge differs from the stream, merged count / records in the stream)
+    """
+    rnd = random.Random(1)
+    exact = {}
+    partials = [{} for _ in range(replicas)]
+    for i in range(records):
+        start = rnd.randrange(windows) * size
+        key = 'key%d' % rnd.randrange(keys)
+        v = rnd.lognormvariate(0, 1)
+        exact.setdefault((start, key), []).append(v)
+        targets = [i % replicas] if shared else range(replicas)
+        for r in targets:
+            if (start, key) not in partials[r]:
+                partials[r][(start, key)] = utl.Aggregate()
+            partials[r][(start, key)].add(v)
+
+    merger = utl.WindowMerger(lateness=size)
+    for r in range(replicas):
+        batches = {}
+        for (start, key), agg in partials[r].items():
+            batches.setdefault(start, {})[key] = agg
+        for start, batch in batches.items():
+            merger.add(start, size, 'map%d' % r, batch)
+    errors = 0
+    merged = 0
+    for start, _, _, window in merger.advance(float('inf')):
+        for key, agg in window.items():
+            raw = exact[(start, key)]
+            merged += agg.count
+            if agg.count != len(raw) or abs(agg.sum - sum(raw)) > 1e-6 * len(raw) or \
+                    agg.min != min(raw) or agg.max != max(raw):
+                errors += 1
+    return errors, merged / float(records)
+
+
+def stream_tasks(streams, duration, max_rate, queue_size, consume_rate):
+    """
+    Feed fast fake log generators through a TaskStreamer with a slow handler
+    :return: dict of results
+    """
+    def fake_log(n):
+        i = 0
+        while True:
+            yield 'task %d line %d ' % (n, i) + 'x' * 80
+            i += 1
+
+    streamer = TaskStreamer(queue_size=queue_size, max_rate=max_rate, duration=duration)
+    for n in range(streams):
+        streamer.add_stream('task%d' % n, 'node%d' % (n % 3), 'log', fake_log(n))
+    handled = [0]
+
+    def handle(task, node, kind, line):
+        handled[0] += 1
+        if consume_rate:
+            time.sleep(1.0 / consume_rate)
+
+    tracemalloc.start()
+    begin = time.time()
+    streamer.run(handle)
+    elapsed = time.time() - begin
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    summary = streamer.summary()
+    return {'handled': handled[0], 'emitted': sum(r[3] for r in summary), 'dropped': sum(r[4] for r in summary),
+            'limited': sum(r[5] for r in summary), 'elapsed': elapsed, 'peak_kb': peak / 1024.0}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-m', '--mode', type=str, default='queue', choices=['queue', 'reduce', 'stream'],
+                        help='queue: MessageQueue overload, reduce: Map partials merged by Reduce, '
+                             'stream: fake task logs multiplexed by TaskStreamer')
+    parser.add_argument('-q', '--queue_size', type=int, default=1000, help='Max number of queued messages')
+    parser.add_argument('-d', '--duration', type=float, default=5, help='Seconds per policy')
+    parser.add_argument('--produce_rate', type=float, default=20000, help='Messages per second delivered')
+    parser.add_argument('--consume_rate', type=float, default=500, help='Messages per second handled')
+    parser.add_argument('--payload_size', type=int, default=64, help='Payload bytes per message')
+    parser.add_argument('--sources', type=int, default=6, help='Map replicas')
+    parser.add_argument('--keys', type=int, default=200, help='Distinct keys per window')
+    parser.add_argument('--windows', type=int, default=20, help='Number of windows')
+    parser.add_argument('--values', type=int, default=20, help='Raw values per replica, window and key')
+    parser.add_argument('--shards', type=int, default=3, help='Reduce replicas')
+    parser.add_argument('--lateness', type=int, default=5, help='Allowed lateness in seconds')
+    parser.add_argument('--late_ratio', type=float, default=0.05, help='Share of Map batches delivered too late')
+    parser.add_argument('--dup_ratio', type=float, default=0.1, help='Share of Map batches delivered twice')
+    parser.add_argument('--streams', type=int, default=50, help='Fake task log streams')
+    parser.add_argument('--max_rate', type=float, default=None, help='Max lines per second per stream')
+    args = parser.parse_args()
+
+    if args.mode == 'stream':
+        r = stream_tasks(args.streams, args.duration, args.max_rate, args.queue_size, args.consume_rate)
+        print('streams=%d ran %.2fs of %.2fs handled=%d emitted=%d dropped=%d rate_limited=%d peak=%.1fKB' %
+              (args.streams, r['elapsed'], args.duration, r['handled'], r['emitted'], r['dropped'], r['limited'],
+               r['peak_kb']))
+        # the time bound must hold however many streams compete with the consumer
+        sys.exit(0 if r['elapsed'] < args.duration + 0.5 else 1)
+
+    if args.mode == 'reduce':
+        r = reduce_merge(args.sources, args.keys, args.windows, 5, args.values, args.shards, args.lateness,
+                         args.late_ratio, args.dup_ratio)
+        print('batches=%d in %.2fs (%.0f batches/s, %.0f key partials/s) errors=%d missing=%d late=%d/%d '
+              'duplicate=%d/%d max quantile error=%.4f' %
+              (r['batches'], r['elapsed'], r['batches'] / r['elapsed'], r['merged_keys'] / r['elapsed'],
+               r['errors'], r['missing'], r['late'], r['injected_late'], r['duplicate'], r['injected_dup'],
+               r['max_rel_err']))
+        # replicas of one Map service all subscribe to the same topic
+        shared_errors, shared_factor = replica_split(3, 100000, args.windows, 5, args.keys, shared=True)
+        plain_errors, plain_factor = replica_split(3, 100000, args.windows, 5, args.keys, shared=False)
+        print('3 Map replicas on one stream: shared subscription errors=%d counted %.2fx, '
+              'plain subscription errors=%d counted %.2fx' % (shared_errors, shared_factor, plain_errors, plain_factor))
+        sys.exit(0 if not r['errors'] and not r['missing'] and r['late'] == r['injected_late'] and
+                 r['duplicate'] == r['injected_dup'] and not shared_errors else 1)
+
+    lost = 0
+    for service in SERVICES:
+        mq_class = load_utl(service).MessageQueue
+        for policy in mq_class.POLICIES:
+            r = overload(mq_class, policy, args.queue_size, args.duration, args.produce_rate, args.consume_rate,
+                         args.payload_size)
+            lost += abs(r['lost'])
+            print('%-8s %-12s produced=%-8d consumed=%-6d shed=%-8d held=%-6d uncounted=%-3d pauses=%-4d '
+                  'max_depth=%-6d peak=%.1fKB' % (service, policy, r['produced'], r['consumed'], r['shed'], r['held'],
+                                                  r['lost'], r['pauses'], r['max_depth'], r['peak_kb']))
+    sys.exit(0 if not lost else 1)
@@ -0,0 +1,159 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import time
+import threading
+import queue
+
+
+class TaskStreamer(object):
+    """
+    Multiplex many line streams (task logs, container stats) into one bounded queue.
+    Every stream is drained by its own daemon thread, lines are tagged with the task and node
+    they come from, and the consumer side never holds more than queue_size lines in memory.
+    A stream that is over its rate or finds the queue full waits instead of reading on, so the
+    backlog stays in the source (the docker daemon) and no thread spins against the consumer.
+    """
+
+    def __init__(self, queue_size=1000, max_rate=None, duration=None, max_line_len=4096):
+        """
+        :param queue_size: capacity of the shared output queue, streams wait while it is full
+        :param max_rate: max lines per second read from a single stream, None means unlimited
+        :param duration: stop streaming after this many seconds, None means run until all streams end
+        :param max_line_len: longer lines are truncated to this length
+        """
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.max_rate = max_rate
+        self.duration = duration
+        self.max_line_len = max_line_len
+        self.stop_event = threading.Event()
+        self.__streams = []
+        self.__threads = []
+        # per stream counters, keyed by (task, node, kind)
+        self.emitted = {}
+        self.dropped = {}
+        self.limited = {}
+
+    def add_stream(self, task, node, kind, source):
+        """
+        Register a stream to follow
+        :param task: task id or name used to tag lines
+        :param node: node id used to tag lines
+        :param kind: stream type, e.g. 'log' or 'stats'
+        :param source: iterable yielding str lines, or (task, node, line) tuples when one source carries many tasks
+        :return:
+        """
+        key = (task, node, kind)
+        self.emitted[key] = 0
+        self.dropped[key] = 0
+        self.limited[key] = 0
+        self.__streams.append((key, source))
+
+    def __pump(self, key, source):
+        # token bucket, refilled at max_rate tokens per second with a burst of one second (at least one line)
+        burst = max(1, self.max_rate or 0)
+        tokens = burst
+        last = time.time()
+        try:
+            for line in source:
+                if self.stop_event.is_set():
+                    break
+                if self.max_rate:
+                    now = time.time()
+                    tokens = min(burst, tokens + (now - last) * self.max_rate)
+                    last = now
+                    if tokens < 1:
+                        # wait for the next token rather than reading and discarding at full speed
+                        self.limited[key] += 1
+                        if self.stop_event.wait((1 - tokens) / self.max_rate):
+                            self.dropped[key] += 1
+                            break
+                        tokens = 1
+                        last = time.time()
+                    tokens -= 1
+                if isinstance(line, tuple):
+                    tag = (line[0], line[1], key[2])
+                    line = line[2]
+                else:
+                    tag = key
+                if not self.__put(tag, line[:self.max_line_len]):
+                    self.dropped[key] += 1
+                    break
+                self.emitted[key] += 1
+        except Exception as ex:
+            if not self.stop_event.is_set():
+                self.__put(key, '[stream error] %s' % ex)
+        finally:
+            if hasattr(source, 'close'):
+                source.close()
+
+    def __put(self, tag, line):
+        # block while the queue is full, but give up as soon as the streamer is stopped
+        while not self.stop_event.is_set():
+            try:
+                self.queue.put((tag, line), timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def run(self, handler):
+        """
+        Start all streams and feed every line to handler until the time bound expires or every stream ends
+        :param handler: callable(task, node, kind, line)
+        :return:
+        """
+        deadline = time.time() + self.duration if self.duration else None
+        for key, source in self.__streams:
+            t = threading.Thread(target=self.__pump, args=(key, source))
+            t.daemon = True
+            t.start()
+            self.__threads.append(t)
+
+        try:
+            while not self.stop_event.is_set():
+                if deadline and time.time() >= deadline:
+                    break
+                try:
+                    tag, line = self.queue.get(timeout=0.1)
+                except queue.Empty:
+                    if not any(t.is_alive() for t in self.__threads):
+                        break
+                    continue
+                handler(tag[0], tag[1], tag[2], line)
+        finally:
+            self.stop()
+
+    def stop(self):
+        """
+        Ask every stream thread to exit; threads blocked on a silent source die with the process
+        :return:
+        """
+        self.stop_event.set()
+
+    def summary(self):
+        """
+        :return: list of (task, node, kind, emitted, dropped on stop, times throttled by the rate limit)
+        """
+        return [key + (self.emitted[key], self.dropped[key], self.limited[key]) for key in self.emitted]
+
+
+def split_lines(chunks, max_line_len=4096):
+    """
+    Turn a stream of raw byte chunks into decoded lines; a partial line is kept for at most max_line_len bytes
+    :param chunks: iterable of bytes
+    :param max_line_len:
+    :return: generator of str
+    """
+    rest = b''
+    for chunk in chunks:
+        rest += chunk
+        lines = rest.split(b'\n')
+        rest = lines.pop()
+        for line in lines:
+            yield line.decode('utf-8', 'replace').rstrip('\r')
+        if len(rest) > max_line_len:
+            yield rest.decode('utf-8', 'replace')
+            rest = b''
+    if rest:
+        yield rest.decode('utf-8', 'replace')